@@ -1,17 +1,141 @@
 from os import path
+from functools import lru_cache
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+import configparser
+import contextvars
+import os
+import selectors
+import shlex
+import subprocess
+import threading
 import logging
 
 from happyai.utility import reporoot, execute
 from happyai import msg
 
-import logging.config
-logging.config.dictConfig({
-    'version': 1,
-    'disable_existing_loggers': True,
-})
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
 
 log = logging.getLogger(__name__)
-log.setLevel(logging.DEBUG)
+log.addHandler(logging.NullHandler())
+
+#: The :class:`GitSession` active in the current context, if any.
+_session = contextvars.ContextVar("giter_session", default=None)
+
+class GitSession(object):
+    """Keeps :mod:`pygit2` repositories open while the session is active so that
+    read-only queries (branch name, detached state, status) don't have to start a
+    new `git` process each time. Without `pygit2` installed the session does
+    nothing and the queries shell out to `git` as usual.
+
+    The session is tracked in a context variable, so concurrent `commit` or
+    `new_branch` calls each get their own; worker threads need to run in a copy of
+    the caller's context to see it.
+
+    Args:
+        folder (str): path to the root repository of the session; submodule
+            repositories are opened lazily as they are queried.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self._repos = {}
+        self._lock = threading.Lock()
+        self._token = None
+
+    def __enter__(self):
+        if pygit2 is not None and _session.get() is None:
+            self._token = _session.set(self)
+            self.open(self.folder)
+        return self
+
+    def __exit__(self, *exc):
+        if self._token is not None:
+            _session.reset(self._token)
+            self._token = None
+        return False
+
+    def open(self, folder):
+        """Returns the :class:`pygit2.Repository` for `folder`, opening it if this
+        session hasn't yet; `None` if it can't be opened.
+        """
+        with self._lock:
+            if folder not in self._repos:
+                try:
+                    self._repos[folder] = pygit2.Repository(folder)
+                except (pygit2.GitError, KeyError):
+                    log.debug("Couldn't open %s with pygit2; using git instead.", folder)
+                    self._repos[folder] = None
+            return self._repos[folder]
+
+    @staticmethod
+    def repo(folder):
+        """Returns the open :class:`pygit2.Repository` for `folder`, or `None` if
+        no session is active or the repository can't be opened.
+        """
+        session = _session.get()
+        if session is None:
+            return None
+
+        return session.open(folder)
+
+
+def _execute_raw(args, folder):
+    """Executes `args` in `folder` without splitting the output into lines.
+
+    Returns:
+        dict: with `raw` (bytes) from stdout, `error` (bytes) from stderr and the
+        process `returncode`.
+    """
+    result = subprocess.run(args, cwd=folder, capture_output=True)
+    return {"raw": result.stdout, "error": result.stderr, "returncode": result.returncode}
+
+
+def _iter_lines(args, folder):
+    """Executes `args` in `folder`, yielding stdout lines (bytes) as soon as they are
+    produced. If the caller stops iterating early, the process is terminated; stderr
+    is drained and discarded.
+    """
+    proc = subprocess.Popen(args, cwd=folder, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    sel = selectors.DefaultSelector()
+    sel.register(proc.stdout, selectors.EVENT_READ)
+    sel.register(proc.stderr, selectors.EVENT_READ)
+    buf = bytearray()
+    try:
+        while len(sel.get_map()) > 0:
+            for key, _ in sel.select():
+                chunk = os.read(key.fileobj.fileno(), 65536)
+                if not chunk:
+                    sel.unregister(key.fileobj)
+                    continue
+                if key.fileobj is not proc.stdout:
+                    continue
+
+                buf.extend(chunk)
+                start, end = 0, buf.find(b"\n")
+                while end >= 0:
+                    yield bytes(buf[start:end])
+                    start, end = end + 1, buf.find(b"\n", end + 1)
+                del buf[:start]
+
+        if len(buf) > 0:
+            yield bytes(buf)
+    finally:
+        sel.close()
+        if proc.poll() is None:
+            proc.terminate()
+        proc.stdout.close()
+        proc.stderr.close()
+        proc.wait()
+
+
+_XY = b" MTADRCU"
+#: Two-character `XY` status codes that start a `git status --porcelain=v1` entry.
+_DIRTY_CODES = frozenset({bytes([x, y]) for x in _XY for y in _XY} - {b"  "} | {b"??"})
+
 
 def check_uncommitted_changes(folder=None):
     """Checks if the given the repository at `folder` has uncommitted changes.
@@ -22,33 +146,114 @@ def check_uncommitted_changes(folder=None):
     if folder is None:
         folder = reporoot
 
-    args = ["git", "status", "."]
-    log.info(f"Checking status for repository in {folder}.")
-    result = execute(args, folder, printerr=False)
-    has_changes = len([l for l in result["output"] 
-                        if "not staged" in l or 
-                        "Changes to be committed" in l or 
-                        "Untracked files" in l]) > 0
-
-    if has_changes:
+    log.info("Checking status for repository in %s.", folder)
+    repo = GitSession.repo(folder)
+    if repo is not None:
+        first = next(iter(repo.status(untracked_files="all", ignored=False)), None)
+    else:
+        args = ["git", "status", "--porcelain=v1", "-uall", "."]
+        # Any porcelain entry means the repo is dirty, so stop git at the first one.
+        with closing(_iter_lines(args, folder)) as lines:
+            first = next((l for l in lines if l[:2] in _DIRTY_CODES), None)
+        if first is not None:
+            first = first.decode(errors="replace")
+
+    if first is not None:
         msg.warn(f"There are uncommitted changes in the repository at {folder}.")
-        msg.std('\n'.join(result["output"]))
+        msg.std(first)
         return True
 
     return False
 
 
+def _git_dir(folder):
+    """Returns the path to the `.git` directory for the repo at `folder`; for
+    submodules `.git` is a file pointing to the real directory.
+    """
+    gitpath = path.join(folder, ".git")
+    if path.isfile(gitpath):
+        with open(gitpath) as f:
+            line = f.readline().strip()
+        if line.startswith("gitdir:"):
+            return path.normpath(path.join(folder, line[len("gitdir:"):].strip()))
+
+    return gitpath
+
+
+def _mtime(target):
+    """Returns the modification time of `target` in nanoseconds, or `None` if it
+    doesn't exist.
+    """
+    try:
+        return os.stat(target).st_mtime_ns
+    except OSError:
+        return None
+
+
 def get_branch_name(folder):
     """Gets the branch name for the repo at folder.
+
+    Returns:
+        str: name of the current branch; `None` if HEAD is detached or the branch
+        could not be determined.
+    """
+    repo = GitSession.repo(folder)
+    if repo is not None:
+        if repo.head_is_detached:
+            return None
+        if repo.head_is_unborn:
+            # No commits yet, but HEAD still names the branch to be created.
+            target = repo.references["HEAD"].target
+            return target[len("refs/heads/"):] if target.startswith("refs/heads/") else None
+        return repo.head.shorthand
+
+    head = path.join(_git_dir(folder), "HEAD")
+    return _get_branch_name(folder, _mtime(head))
+
+
+@lru_cache(maxsize=64)
+def _get_branch_name(folder, stamp):
+    """Cached implementation of :func:`get_branch_name`; `stamp` is the mtime of
+    `HEAD` so that checkouts made outside this module invalidate the entry.
     """
-    args = ["git", "status"]
+    # Unlike `rev-parse --abbrev-ref`, this also works before the first commit and
+    # prints nothing (rather than `HEAD`) when detached.
+    args = ["git", "symbolic-ref", "-q", "--short", "HEAD"]
     output = execute(args, folder, printerr=False)
-    matching = [l for l in output["output"] if "On branch" in l]
-    if len(matching) == 1:
-        return matching[0].split()[-1]
-    else:
+    if len(output["output"]) == 0:
         return None
 
+    return output["output"][0].strip()
+
+
+#: Prefix of the line `_BRANCH_SNIPPET` writes to stderr when it fails; git's own
+#: `fatal:` messages never carry it.
+_BRANCH_FAILED = "fatal: giter:"
+
+_BRANCH_SNIPPET = """
+where="${4:-$PWD}"
+fail() {
+    if [ "$stashed" = 1 ]; then git stash pop; fi
+    # Exit cleanly so that `git submodule foreach` carries on with the others.
+    echo "fatal: giter: couldn't auto-branch the repo at $where." >&2
+    exit 0
+}
+if [ "$(git symbolic-ref -q --short HEAD)" = "$1" ]; then exit 0; fi
+stashed=0
+if [ "$2" = 1 ] && [ -n "$(git status --porcelain=v1 -uall --ignore-submodules .)" ]; then
+    # Only pop later if this push actually created a stash entry.
+    before="$(git rev-parse -q --verify refs/stash)"
+    git stash push --include-untracked -m giter-auto || fail
+    if [ "$(git rev-parse -q --verify refs/stash)" != "$before" ]; then stashed=1; fi
+fi
+git checkout -b "$1" || fail
+if [ "$3" = 1 ]; then git checkout -b "$1/sandbox" || fail; fi
+if [ "$stashed" = 1 ]; then
+    stashed=0
+    git stash pop || fail
+fi
+"""
+
 
 def _git_branch(folder, branch, stash=False, sandbox=True):
     """Branches the given folder, stashing and reapplying changes if necessary.
@@ -58,38 +263,81 @@ def _git_branch(folder, branch, stash=False, sandbox=True):
             then reapply to the new branch.
     """
     if get_branch_name(folder) != branch:
-        argslist = []
-        if stash:
-            if check_uncommitted_changes(folder):
-                argslist.append(["git", "stash"])
-
-        argslist.append((["git", "checkout", "-b", branch], _branch_error_analyzer))
-        if sandbox:
-            argslist.append((["git", "checkout", "-b", f"{branch}/sandbox"], _branch_error_analyzer))
-
-        if len(argslist) == 2:
-            argslist.append(["git", "stash", "apply"])
-
-        log.debug(f"Executing branching using {argslist} in {folder}.")
-        return _multi_execute(argslist, folder, f"Couldn't auto-branch the repo at {folder}.")
+        # Stash, checkout(s) and pop run in one shell; see `_BRANCH_SNIPPET`.
+        args = ["sh", "-c", _BRANCH_SNIPPET, "giter", branch, str(int(stash)), str(int(sandbox))]
+        log.debug("Executing branching to %s in %s.", branch, folder)
+        success = _multi_execute([(args, _branch_error_analyzer)], folder,
+                                 f"Couldn't auto-branch the repo at {folder}.")
+        if success:
+            _get_branch_name.cache_clear()
+        return success
 
     else:
-        log.debug(f"Repo already on branch {branch}.")
+        log.debug("Repo already on branch %s.", branch)
         return True
 
 
-def ls_submodules(folder):
+def ls_submodules(folder, recursive=False):
     """Lists all the submodules in the given folder.
+
+    Args:
+        folder (str): path to the repository to list submodules for.
+        recursive (bool): when True, also list the submodules nested inside the
+            submodules, with paths relative to `folder`.
+    """
+    if recursive:
+        return list(_ls_submodules_recursive(folder))
+
+    return list(_ls_submodules(folder, _mtime(path.join(folder, ".gitmodules"))))
+
+
+def _submodule_dirs(folder):
+    """Lists the paths to all the submodules, at every depth, in the given folder;
+    see :func:`ls_submodules`.
     """
+    prefix = folder.rstrip(os.sep) + os.sep
+    return tuple(prefix + s for s in _ls_submodules_recursive(folder))
+
+
+def _ls_submodules_recursive(folder):
+    """Lists the submodules of `folder` at every depth using a single
+    `git submodule foreach --recursive`; parents are listed before their children.
+    """
+    if not path.isfile(path.join(folder, ".gitmodules")):
+        return ()
+
+    sm_args = ["git", "submodule", "foreach", "--recursive", "--quiet", "echo $displaypath"]
+    sm_output = execute(sm_args, folder, printerr=False)
+    log.debug("Finding nested submodules in %s from process output %s", folder, sm_output)
+    return tuple(l.strip() for l in sm_output["output"] if l.strip())
+
+
+@lru_cache(maxsize=64)
+def _ls_submodules(folder, stamp):
+    """Cached implementation of :func:`ls_submodules`; `stamp` is the mtime of
+    `.gitmodules` so that adding or removing submodules invalidates the entry.
+    """
+    gitmodules = path.join(folder, ".gitmodules")
+    if path.isfile(gitmodules):
+        cp = configparser.ConfigParser(interpolation=None)
+        try:
+            cp.read(gitmodules)
+        except configparser.Error:
+            log.debug("Couldn't parse %s; falling back to `git submodule status`.", gitmodules)
+        else:
+            return tuple(cp[s]["path"] for s in cp.sections()
+                         if s.startswith("submodule ") and "path" in cp[s])
+
     sm_args = ["git", "submodule", "status"]
-    sm_output = execute(sm_args)
-    log.debug(f"Finding submodules in {folder} from process output {sm_output}")
+    sm_output = execute(sm_args, folder)
+    log.debug("Finding submodules in %s from process output %s", folder, sm_output)
     submodules = []
     for line in sm_output["output"]:
         parts = line.split()
-        submodules.append(parts[1][3:])
+        if len(parts) >= 2:
+            submodules.append(parts[1])
 
-    return submodules
+    return tuple(submodules)
 
 
 def new_branch(branch, folder=None, stash=False, sandbox=False):
@@ -110,16 +358,38 @@ def new_branch(branch, folder=None, stash=False, sandbox=False):
     if folder is None:
         folder = reporoot
 
-    error = False
-    if _git_branch(folder, branch, stash=stash, sandbox=sandbox):
-        for submodule in ls_submodules(folder):
-            subdir = path.join(folder, submodule)
-            log.debug(f"Processing branching for submodule {subdir}.")
-            error = not _git_branch(subdir, branch, stash=stash, sandbox=sandbox) or error
-    else:
-        error = True
+    with GitSession(folder):
+        error = False
+        if _git_branch(folder, branch, stash=stash, sandbox=sandbox):
+            if len(ls_submodules(folder)) > 0:
+                log.debug("Processing branching for submodules of %s.", folder)
+                error = not _git_branch_submodules(folder, branch, stash=stash, sandbox=sandbox)
+        else:
+            error = True
+
+        return not error
 
-    return not error
+
+def _git_branch_submodules(folder, branch, stash=False, sandbox=True):
+    """Branches every submodule (recursively) of the repo at `folder` using a single
+    `git submodule foreach` so that the per-submodule work runs in one shell. See
+    :func:`_git_branch` for the arguments.
+    """
+    # `$displaypath` is only set for a command given as a single shell string, so
+    # quote the snippet and its arguments and hand the path on as the last one.
+    snippet = ["sh", "-c", _BRANCH_SNIPPET, "giter", branch, str(int(stash)), str(int(sandbox))]
+    command = " ".join(shlex.quote(a) for a in snippet) + ' "$displaypath"'
+    args = ["git", "submodule", "foreach", "--recursive", command]
+    log.debug("Executing submodule branching to %s in %s.", branch, folder)
+    output = execute(args, folder, printerr=False)
+    _get_branch_name.cache_clear()
+
+    # The snippet reports each failing submodule without stopping the foreach.
+    failed = [l for l in output["error"] if l.startswith(_BRANCH_FAILED)]
+    for l in failed:
+        msg.warn(l[len(_BRANCH_FAILED):].strip())
+
+    return len(failed) == 0
 
 
 def is_detached(folder):
@@ -128,45 +398,87 @@ def is_detached(folder):
     Args:
         folder (str): path to the repository to check.
     """
-    args = ["git", "status"]
-    output = execute(args, folder)
-    return "HEAD detached at" in output["output"][0]
+    repo = GitSession.repo(folder)
+    if repo is not None:
+        return repo.head_is_detached
+
+    # `symbolic-ref` exits non-zero exactly when HEAD isn't pointing at a branch.
+    args = ["git", "symbolic-ref", "-q", "HEAD"]
+    return _execute_raw(args, folder)["returncode"] != 0
 
 
 def _branch_error_analyzer(output):
-    """Checks if there is an error in `output` for branch creation.
+    """Checks if there is an error in `output` for `_BRANCH_SNIPPET`; only its own
+    failure line counts, since git may print harmless `fatal:` messages along the way.
     """
-    if len(output["error"]) > 0:
-        l = output["error"][0]
-        return "Switched to a new branch" not in l
-    else:
-        return False
+    return any(l.startswith(_BRANCH_FAILED) for l in output["error"])
 
 
-def _multi_execute(argslist, subdir, error_msg):
-    """Executes a series of commands in subprocesses.
+def _checkout_error_analyzer(output):
+    """Checks if there is an error in `output` for a `git checkout`; git always
+    reports the switch itself (e.g. `Switched to branch`) on stderr.
+    """
+    return any(l.startswith(("error:", "fatal:")) for l in output["error"])
+
+
+def _pipeline(argslist):
+    """Collapses contiguous commands without an error analyzer into a single
+    `sh -c 'cmd1 && cmd2 && ...'` so that they share one subprocess. A failing step
+    stops the chain and reports itself on stderr, since some commands (e.g. a
+    conflicting `git merge`) only write to stdout when they fail.
 
     Args:
-        argslist (list): of `tuple` with `(arglist, e_analyzer)` to pass to :func:`execute`.
-        subdir (str): path to the folder to execute in.
-        error_msg (str): error message to display if any of the commands fails.
+        argslist (list): of `tuple` with `(arglist, e_analyzer)` or plain `arglist`.
 
     Returns:
-        bool: `True` if the execution was successful for all steps.
+        list: of `tuple` with `(arglist, e_analyzer)` to pass to :func:`execute`.
     """
+    result, run = [], []
+    def flush():
+        if len(run) == 1:
+            result.append((run[0], None))
+        elif len(run) > 1:
+            chain = " && ".join(" ".join(map(shlex.quote, a)) for a in run)
+            failed = shlex.quote(f"fatal: giter: command failed in: {chain}")
+            result.append((["sh", "-c", f"{{ {chain}; }} || {{ echo {failed} >&2; exit 1; }}"], None))
+        run.clear()
+
     for atup in argslist:
         if isinstance(atup, tuple):
             a, e_analyzer = atup
         else:
             a, e_analyzer = atup, None
 
-        log.debug(f"Executing {a} in {subdir}")
+        if e_analyzer is None:
+            run.append(a)
+        else:
+            flush()
+            result.append((a, e_analyzer))
+
+    flush()
+    return result
+
+
+def _multi_execute(argslist, subdir, error_msg):
+    """Executes a series of commands in subprocesses.
+
+    Args:
+        argslist (list): of `tuple` with `(arglist, e_analyzer)` to pass to :func:`execute`.
+        subdir (str): path to the folder to execute in.
+        error_msg (str): error message to display if any of the commands fails.
+
+    Returns:
+        bool: `True` if the execution was successful for all steps.
+    """
+    for a, e_analyzer in _pipeline(argslist):
+        log.debug("Executing %s in %s", a, subdir)
         o = execute(a, subdir, printerr=False)
-        log.debug(o)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Output: %r", o)
         error = False
         if e_analyzer is not None:
             error = e_analyzer(o)
-            log.debug(o, error)
+            log.debug("Error analysis of %s output: %s", a, error)
         elif len(o["error"]) > 0:
             error = True
 
@@ -177,66 +489,173 @@ def _multi_execute(argslist, subdir, error_msg):
         return True
 
 
-def _commit_printer(output):
-    """Pretty-prints the commit results from :func:`_commit_repo`.
-    """
-    if len(output["error"]) == 0:
-        o = output["output"]
-        if len(o) >= 2:
-            msg.okay(o[1])
-
-        return True
-
-    return False
-
-
-def _commit_repo(folder, message):
+def _commit_repo(folder, message, known_dirty=None):
     """Commits the changes in the repo at `folder`.
+
+    Args:
+        known_dirty (bool): whether the repo is already known to have uncommitted
+            changes; if `None`, :func:`check_uncommitted_changes` is called.
     """
-    if check_uncommitted_changes(folder):
+    if known_dirty is None:
+        known_dirty = check_uncommitted_changes(folder)
+
+    if known_dirty:
         argslist = [
                 ["git", "add", "."],
-                (["git", "commit", "-m", f'"{message}"'], _commit_printer)
+                ["git", "commit", "--quiet", "-m", message]
             ]
 
         submodule = path.dirname(folder)
-        return _multi_execute(argslist, folder, f"Could not auto-commit changes in {submodule}.")
+        success = _multi_execute(argslist, folder, f"Could not auto-commit changes in {submodule}.")
+        if success:
+            msg.okay(f"Committed changes in {folder}.")
+        return success
     else:
         log.debug("No uncommitted changes; skipping commit repo.")
         return True
 
 
-def commit(message, folder=None):
-    """Commits the changes in each of the submodules, creating new branches if necessary.
+def _dirty_submodules(folder):
+    """Finds the direct submodules of `folder` with uncommitted changes (tracked or
+    untracked) from a single `git status` of the parent repo.
+
+    Returns:
+        set: of submodule paths relative to `folder`; `None` if `git status` failed,
+        in which case nothing is known about the submodules.
     """
-    if folder is None:
-        folder = reporoot
-    branch = get_branch_name(folder)
+    args = ["git", "status", "--porcelain=v2", "-z", "--ignore-submodules=none"]
+    result = _execute_raw(args, folder)
+    if result["returncode"] != 0:
+        log.debug("Status of %s failed: %s", folder, result["error"])
+        return None
 
-    has_error = False
-    for submodule in ls_submodules(folder):
-        subdir = path.join(folder, submodule)
+    fields = result["raw"].split(b"\0")
+    dirty = set()
+    i = 0
+    while i < len(fields):
+        entry = fields[i]
+        if entry.startswith(b"1 "):
+            parts = entry.split(b" ", 8)
+            # The submodule state is `S<c><m><u>`; only modified or untracked
+            # content needs a commit inside the submodule itself.
+            sub = parts[2]
+            if sub.startswith(b"S") and (sub[2:3] == b"M" or sub[3:4] == b"U"):
+                dirty.add(os.fsdecode(parts[8]))
+        elif entry.startswith(b"2 "):
+            # Renames are followed by a separate field with the original path.
+            i += 1
+        i += 1
+
+    return dirty
+
+
+def _submodule_states(folder, subdirs):
+    """Works out which of the (possibly nested) submodules at `subdirs` need to be
+    committed, using :func:`_dirty_submodules`.
 
-        if not _commit_repo(subdir, message):
-            # No sense trying to do anything else since we failed earlier.
-            has_error = True
+    Returns:
+        dict: keyed by entries in `subdirs`, with `known_dirty` values for
+        :func:`_commit_repo`; `None` where it can't be decided from the parent repo.
+    """
+    dirty = _dirty_submodules(folder)
+    if dirty is None:
+        # Let each submodule check its own status instead.
+        return {subdir: None for subdir in subdirs}
+
+    direct = ls_submodules(folder)
+    prefix = folder.rstrip(os.sep) + os.sep
+    states = {}
+    for subdir in subdirs:
+        rel = subdir[len(prefix):]
+        if rel in direct:
+            states[subdir] = rel in dirty
             continue
 
-        if is_detached(subdir):
-            # Get changes into a new branch, then checkout and merge.
-            argslist = [
-                ["git", "branch", "tmp"],
-                # Here we are using the dsci-analysis branch name for detached heads.
-                ["git", "checkout", branch],
-                ["git", "merge", "tmp"],
-                ["git", "branch", "-d", "tmp"]
-            ]
+        # A nested submodule can only be dirty if its top-level submodule is, but
+        # the parent repo's status can't tell which nested one it is.
+        top = next((d for d in direct if rel.startswith(d + "/")), None)
+        states[subdir] = None if top is None or top in dirty else False
 
-            if not _multi_execute(argslist, subdir, f"Could not recover branch from detached head state."):
-                has_error = True
+    return states
 
-    #Now that all the submodules are committed, also commit the parent repo.
-    if not has_error:
-        _commit_repo(folder, message)
-    else:
-        log.debug("Errors present in submodule repo commits; cannot commit parent repo.")
+
+def _commit_submodule(subdir, message, branch, known_dirty=None):
+    """Commits the changes in the submodule at `subdir`, recovering `branch` if the
+    submodule is in a detached HEAD state.
+
+    Returns:
+        bool: `True` if the commit (and any branch recovery) was successful.
+    """
+    if not _commit_repo(subdir, message, known_dirty):
+        # No sense trying to do anything else since we failed earlier.
+        return False
+
+    if is_detached(subdir):
+        # Get changes into a new branch, then checkout and merge.
+        argslist = [
+            ["git", "branch", "tmp"],
+            # Here we are using the dsci-analysis branch name for detached heads.
+            (["git", "checkout", branch], _checkout_error_analyzer),
+            ["git", "merge", "tmp"],
+            ["git", "branch", "-d", "tmp"]
+        ]
+
+        return _multi_execute(argslist, subdir, f"Could not recover branch from detached head state.")
+
+    return True
+
+
+def commit(message, folder=None):
+    """Commits the changes in each of the submodules, creating new branches if necessary.
+    """
+    if folder is None:
+        folder = reporoot
+    with GitSession(folder):
+        branch = get_branch_name(folder)
+
+        subdirs = _submodule_dirs(folder)
+        states = _submodule_states(folder, subdirs) if len(subdirs) > 0 else {}
+        # Nested submodules have to be committed before the submodule that contains
+        # them so the parent picks up their new commits; a nested path always has
+        # more components than its parent's, so go deepest level first.
+        levels = {}
+        for subdir in subdirs:
+            levels.setdefault(subdir.count(os.sep), []).append(subdir)
+
+        failed = []
+        for depth in sorted(levels, reverse=True):
+            # A submodule containing a failed one would record a stale commit for
+            # it, so skip it (and, in turn, its own ancestors).
+            level = []
+            for subdir in levels[depth]:
+                if any(f.startswith(subdir + os.sep) for f in failed):
+                    log.debug("Skipping %s since a nested submodule failed.", subdir)
+                    failed.append(subdir)
+                else:
+                    level.append(subdir)
+
+            if len(level) == 0:
+                continue
+
+            # Submodules have independent indexes, so they can be handled concurrently.
+            workers = min(len(level), (os.cpu_count() or 1)*2)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # Each task runs in its own copy of this context to see the session.
+                futures = [executor.submit(contextvars.copy_context().run, _commit_submodule,
+                                           d, message, branch, states[d])
+                           for d in level]
+                done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+                for f in done:
+                    if f.exception() is not None:
+                        # Don't start any more submodules, and never commit the parent.
+                        for p in pending:
+                            p.cancel()
+                        raise f.exception()
+
+                failed.extend(d for d, f in zip(level, futures) if not f.result())
+
+        #Now that all the submodules are committed, also commit the parent repo.
+        if len(failed) == 0:
+            _commit_repo(folder, message)
+        else:
+            log.debug("Errors present in submodule repo commits; cannot commit parent repo.")
@@ -1,2 +1,2 @@
-python setup.py sdist bdist_wheel
+python -m build
 twine upload dist/*
\ No newline at end of file